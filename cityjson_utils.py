@@ -0,0 +1,195 @@
+"""
+Helpers shared by the CityJSON repair scripts: reading and writing files
+(optionally streamed), remapping boundary indices and merging duplicate
+vertices.
+"""
+import json
+from itertools import chain, islice
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    # Fall back to the (slower) standard library encoder/decoder
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    # Only needed for streaming
+    ijson = None
+
+# Raised for a file that isn't valid JSON, by whichever parser read it
+JSON_ERRORS = (json.JSONDecodeError, *((ijson.JSONError,) if ijson else ()))
+
+# --- Reading and writing ---
+def load_json(path):
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read()) if orjson else json.load(f)
+
+def to_json(obj):
+    # Vertices may be kept as a NumPy array, which both encoders can write
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(',', ':'), default=np.ndarray.tolist).encode()
+
+def read_header(path):
+    """Read every top-level member of the file except CityObjects (needs ijson)."""
+    members = {}
+    key = builder = None
+    with open(path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == '':
+                if event == 'map_key':
+                    key = value
+                    builder = None if key == 'CityObjects' else ijson.ObjectBuilder()
+                continue
+            if builder is None:
+                continue
+            builder.event(event, value)
+            if prefix == key and event not in ('start_map', 'start_array', 'map_key'):
+                members[key] = builder.value
+                builder = None
+    return members
+
+def stream_city_objects(path):
+    """Yield the (id, CityObject) pairs of the file one at a time (needs ijson)."""
+    with open(path, 'rb') as f:
+        yield from ijson.kvitems(f, 'CityObjects', use_float=True)
+
+def write_streamed(path, header, city_objects):
+    """
+    Write `header` followed by the (id, CityObject) pairs of `city_objects`,
+    each one as soon as it is produced, so only one object is held at a time.
+    """
+    with open(path, 'wb') as out:
+        out.write(b'{')
+        for key, value in header.items():
+            out.write(to_json(key) + b':' + to_json(value) + b',')
+        out.write(b'"CityObjects":{')
+        for n, (obj_id, city_object) in enumerate(city_objects):
+            out.write((b',' if n else b'') + to_json(obj_id) + b':' + to_json(city_object))
+        out.write(b'}}')
+
+# --- Boundaries ---
+def collect_rings(boundaries):
+    """Return every innermost list of vertex indices, found with an explicit stack."""
+    rings = []
+    stack = [boundaries]
+    pop, extend, add_ring = stack.pop, stack.extend, rings.append
+    # Parsed JSON only contains plain lists, so an exact type check will do
+    _list = list
+    while stack:
+        items = pop()
+        if not items:
+            continue
+        if type(items[0]) is _list:
+            extend(items)
+        else:
+            add_ring(items)
+    return rings
+
+def flatten_rings(rings):
+    return np.fromiter(chain.from_iterable(rings), dtype=np.int64, count=sum(map(len, rings)))
+
+def write_rings(rings, values):
+    """Copy the flat array `values` back into `rings`, in place."""
+    values = iter(values.tolist())
+    for ring in rings:
+        ring[:] = islice(values, len(ring))
+
+def update_boundaries(boundaries, mapping):
+    """Remap every vertex index in `boundaries` in place with one gather."""
+    rings = collect_rings(boundaries)
+    write_rings(rings, mapping[flatten_rings(rings)])
+
+# --- Vertices ---
+def quantize(vertices, precision):
+    """
+    Snap the (N, 3) vertices to an integer grid of 10**-precision. Integer
+    vertices (files with a "transform") already lie on a grid and are kept
+    as they are.
+    """
+    if np.issubdtype(vertices.dtype, np.integer):
+        return vertices.astype(np.int64, copy=False)
+    return np.round(vertices * 10 ** precision).astype(np.int64)
+
+def merge_vertices(vertices, precision, tolerance=None, transitive=True):
+    """
+    Find the duplicates in an (N, 3) vertex array. Vertices are equal when
+    they round to the same point at `precision` decimals (or have exactly
+    the same coordinates if `precision` is None) or, if `tolerance` is
+    given, lie less than `tolerance` apart (needs scipy).
+
+    With `transitive`, every chain of points within `tolerance` of each
+    other becomes one vertex, however long the chain. Otherwise points are
+    visited in order of first appearance and each one joins the earliest
+    kept point within `tolerance`, or is kept itself, so a merged point is
+    never further than `tolerance` from its representative when
+    `precision` is None.
+
+    Returns (index_mapping, kept): index_mapping is an int32 array mapping
+    every old index to its new one, and kept holds the old index of each
+    new vertex, in order of first appearance.
+    """
+    # View each (x, y, z) row of int64s (or float64s, with -0.0 turned into
+    # 0.0) as a single opaque 24-byte key, so np.unique compares whole
+    # vertices at once
+    if precision is None:
+        grid = np.ascontiguousarray(vertices, dtype=np.float64) + 0.0
+    else:
+        grid = quantize(vertices, precision)
+    keys = grid.view(np.dtype((np.void, grid.dtype.itemsize * 3))).ravel()
+    _, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # np.unique sorts its keys; renumber them in order of first appearance so
+    # the output keeps the same vertex order as the input
+    order = np.argsort(first_seen)
+    new_index = np.empty_like(order)
+    new_index[order] = np.arange(len(order))
+    index_mapping = new_index[inverse.ravel()]
+    kept = first_seen[order]
+
+    if tolerance:
+        # Imported here so that scripts which never pass a tolerance don't
+        # pay for loading scipy
+        try:
+            from scipy.sparse import coo_matrix
+            from scipy.sparse.csgraph import connected_components
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError("merging vertices within a tolerance needs scipy") from None
+
+        # Rounding keeps apart vertices that sit just either side of a grid
+        # line, so also look for grid points within tolerance of each other
+        points = vertices[kept]
+        pairs = cKDTree(points).query_pairs(r=tolerance, output_type='ndarray')
+        # query_pairs also returns pairs exactly tolerance apart
+        pairs = pairs[((points[pairs[:, 0]] - points[pairs[:, 1]]) ** 2).sum(axis=1) < tolerance * tolerance]
+        if transitive:
+            graph = coo_matrix(
+                (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+                shape=(len(kept), len(kept)),
+            )
+            _, target = connected_components(graph, directed=False)
+            # Number the groups in order of first appearance again
+            _, first, target = np.unique(target, return_index=True, return_inverse=True)
+            renumber = np.empty_like(first)
+            renumber[np.argsort(first)] = np.arange(len(first))
+            index_mapping = renumber[target.ravel()][index_mapping]
+            kept = kept[np.sort(first)]
+        else:
+            # Each pair is (i, j) with i < j; walk them by j and then i, so a
+            # point's own target is settled before any later point looks at it
+            target = list(range(len(kept)))
+            for i, j in pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))].tolist():
+                if target[j] == j and target[i] == i:
+                    target[j] = i
+            target = np.asarray(target)
+            is_kept = target == np.arange(len(target))
+            renumber = np.cumsum(is_kept) - 1
+            index_mapping = renumber[target][index_mapping]
+            kept = kept[is_kept]
+
+    return index_mapping.astype(np.int32), kept
\ No newline at end of file
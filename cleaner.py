@@ -1,5 +1,9 @@
-import json
-import math
+import numpy as np
+
+from cityjson_utils import (
+    JSON_ERRORS, ijson, load_json, merge_vertices, read_header, stream_city_objects,
+    to_json, update_boundaries, write_streamed,
+)
 
 # --- Configuration ---
 INPUT_FILE = 'B4.json'
@@ -7,76 +11,78 @@ OUTPUT_FILE = 'B4_repaired.json'
 # How many decimal places to consider when checking if vertices are identical.
 # This is the most important setting. 5 is usually a safe bet.
 PRECISION = 5
+# Vertices closer together than this are merged too, even when they round to
+# different grid points
+TOLERANCE = 10 ** -PRECISION
+# Stream the CityObjects through one at a time instead of loading the whole
+# file, so memory use stays close to the size of the vertex list. Slower than
+# the default, so only worth it for files that don't fit in memory (needs ijson).
+STREAM = False
 
 print(f"Starting repair process for '{INPUT_FILE}'...")
 
+if STREAM and ijson is None:
+    print("WARNING: STREAM needs the 'ijson' package, loading the whole file instead.")
+    STREAM = False
+
 try:
-    with open(INPUT_FILE, 'r') as f:
-        cm = json.load(f)
+    if STREAM:
+        # CityObjects are read later, one at a time, while saving
+        cm = read_header(INPUT_FILE)
+    else:
+        cm = load_json(INPUT_FILE)
 except FileNotFoundError:
     print(f"ERROR: Input file '{INPUT_FILE}' not found. Make sure it's in the same directory.")
     exit()
-except json.JSONDecodeError:
+except JSON_ERRORS:
     print(f"ERROR: Could not read '{INPUT_FILE}'. It may not be a valid JSON file.")
     exit()
 
 print("Cleaning duplicate vertices...")
 
-old_vertices = cm['vertices']
-new_vertices = []
-# A dictionary to keep track of vertices we've already seen
-# The key is a string like "1.23_4.56_7.89"
-unique_vertices_map = {}
-# An array to map an old vertex index to its new index
-index_mapping = [-1] * len(old_vertices)
-new_idx_counter = 0
-
-for i, v in enumerate(old_vertices):
-    # Round the vertex coordinates to the specified precision
-    rounded_v = [round(coord, PRECISION) for coord in v]
-    # Create a string key from the rounded coordinates
-    vertex_key = "_".join(map(str, rounded_v))
-
-    if vertex_key in unique_vertices_map:
-        # We've seen this vertex before, map the old index to the existing new index
-        index_mapping[i] = unique_vertices_map[vertex_key]
-    else:
-        # This is a new, unique vertex
-        unique_vertices_map[vertex_key] = new_idx_counter
-        index_mapping[i] = new_idx_counter
-        new_vertices.append(v) # Append the original, un-rounded vertex
-        new_idx_counter += 1
+old_vertices = np.asarray(cm['vertices']).reshape(-1, 3)
+
+# Vertices are merged when they round to the same point at PRECISION
+# decimals or lie within TOLERANCE of each other
+index_mapping, kept = merge_vertices(old_vertices, PRECISION, TOLERANCE)
+# Keep the original, un-rounded vertices
+new_vertices = old_vertices[kept]
 
 print(f"Vertex cleaning complete. Original vertices: {len(old_vertices)}, New unique vertices: {len(new_vertices)}")
 
 # Update the main vertices list with the new, clean list
 cm['vertices'] = new_vertices
 
-print("Updating geometry boundaries with new vertex indices...")
+def clean_city_objects(city_objects):
+    update_boundaries([
+        geom['boundaries']
+        for city_object in city_objects if 'geometry' in city_object
+        for geom in city_object['geometry'] if 'boundaries' in geom
+    ], index_mapping)
+
+def cleaned_city_objects():
+    # CityObjects are read, cleaned and written one at a time
+    for obj_id, city_object in stream_city_objects(INPUT_FILE):
+        clean_city_objects([city_object])
+        yield obj_id, city_object
 
 # Now, iterate through all CityObjects and update their geometry boundaries
-def update_boundaries(boundaries):
-    for i, item in enumerate(boundaries):
-        if isinstance(item, list):
-            update_boundaries(item)
-        elif isinstance(item, int):
-            boundaries[i] = index_mapping[item]
-
-for city_object in cm['CityObjects'].values():
-    if 'geometry' in city_object:
-        for geom in city_object['geometry']:
-            if 'boundaries' in geom:
-                update_boundaries(geom['boundaries'])
+if not STREAM:
+    print("Updating geometry boundaries with new vertex indices...")
+    clean_city_objects(cm['CityObjects'].values())
 
 # --- Optional but recommended: Add the referenceSystem if missing ---
 if 'metadata' in cm and 'referenceSystem' not in cm['metadata']:
     print("Adding missing 'referenceSystem' to metadata...")
     cm['metadata']['referenceSystem'] = "https://www.opengis.net/def/crs/EPSG/0/4326"
 
-print("Saving repaired file...")
-
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(cm, f)
+if STREAM:
+    print("Updating geometry boundaries and saving repaired file...")
+    write_streamed(OUTPUT_FILE, cm, cleaned_city_objects())
+else:
+    print("Saving repaired file...")
+    with open(OUTPUT_FILE, 'wb') as f:
+        f.write(to_json(cm))
 
 print(f"\nSUCCESS! Repaired file saved as '{OUTPUT_FILE}'.")
 print("You can now load this new file into your viewer.")
\ No newline at end of file
@@ -1,4 +1,6 @@
-import json
+import numpy as np
+
+from cityjson_utils import load_json, to_json
 
 INPUT_FILE = 'B4.json'
 OUTPUT_FILE = 'B4_repaired_final.json'
@@ -6,69 +8,70 @@ OUTPUT_FILE = 'B4_repaired_final.json'
 print(f"Starting geometry repair for '{INPUT_FILE}'...")
 
 try:
-    with open(INPUT_FILE, 'r') as f:
-        cm = json.load(f)
+    cm = load_json(INPUT_FILE)
 except Exception as e:
     print(f"ERROR: Could not read the input file. {e}")
     exit()
 
-vertices = cm['vertices']
-degenerate_count = 0
+vertices = np.asarray(cm['vertices']).reshape(-1, 3)
+cm['vertices'] = vertices
 total_faces = 0
 
 print("Scanning all objects and filtering out degenerate triangles...")
 
-# --- Helper functions for vector math ---
-def sub(p2, p1):
-    return [p2[0] - p1[0], p2[1] - p1[1], p2[2] - p1[2]]
-
-def cross_product(a, b):
-    return [
-        a[1] * b[2] - a[2] * b[1],
-        a[2] * b[0] - a[0] * b[2],
-        a[0] * b[1] - a[1] * b[0]
-    ]
-
-def length_squared(v):
-    return v[0]**2 + v[1]**2 + v[2]**2
+def is_triangle(face):
+    # Your file has pre-triangulated faces with this structure: [[[v1, v2, v3]]]
+    return len(face) == 1 and len(face[0]) == 1 and len(face[0][0]) == 3
 
-# --- Iterate through all geometries to clean them ---
+# --- Collect every triangle in the file so they can be tested in one batch ---
+geometries = []
+triangles = []
 for city_object in cm['CityObjects'].values():
     if 'geometry' in city_object:
         for geom in city_object['geometry']:
             if 'boundaries' in geom:
-                new_boundaries = []
+                geometries.append(geom)
                 for face in geom['boundaries']:
                     total_faces += 1
-                    # Your file has pre-triangulated faces with this structure: [[[v1, v2, v3]]]
-                    if len(face) == 1 and len(face[0]) == 1 and len(face[0][0]) == 3:
-                        indices = face[0][0]
-                        
-                        # Check for invalid indices before trying to access them
-                        if any(idx >= len(vertices) or idx < 0 for idx in indices):
-                            print(f"Warning: Found invalid vertex index in face {indices}. Skipping.")
-                            degenerate_count += 1
-                            continue
-
-                        p1 = vertices[indices[0]]
-                        p2 = vertices[indices[1]]
-                        p3 = vertices[indices[2]]
-
-                        # Check for collinearity by calculating the area of the triangle.
-                        # If the cross product's length is near zero, the points are on a line.
-                        if length_squared(cross_product(sub(p2, p1), sub(p3, p1))) < 1e-12:
-                            degenerate_count += 1
-                        else:
-                            new_boundaries.append(face)
-                    else:
-                        # Keep any non-triangular faces (though there shouldn't be any)
-                        new_boundaries.append(face)
-                
-                geom['boundaries'] = new_boundaries
+                    if is_triangle(face):
+                        triangles.append(face[0][0])
+
+indices = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+# Check for invalid indices before trying to access them
+valid = ((indices >= 0) & (indices < len(vertices))).all(axis=1)
+for bad in indices[~valid].tolist():
+    print(f"Warning: Found invalid vertex index in face {bad}. Skipping.")
+
+# Triangles that reuse a vertex index are degenerate without looking at any
+# coordinates, so only the rest go through the cross product
+i0, i1, i2 = indices[:, 0], indices[:, 1], indices[:, 2]
+collapsed = (i0 == i1) | (i1 == i2) | (i0 == i2)
+keep = valid & ~collapsed
+checked_mask = keep.copy()
+checked = indices[checked_mask]
+
+# Do the math in float64 even if the file stores integer coordinates
+points = vertices.astype(np.float64, copy=False)
+p1 = points[checked[:, 0]]
+p2 = points[checked[:, 1]]
+p3 = points[checked[:, 2]]
+
+# Check for collinearity by calculating the area of each triangle.
+# If the cross product's length is near zero, the points are on a line.
+cross = np.cross(p2 - p1, p3 - p1)
+keep[checked_mask] = ~((cross * cross).sum(axis=1) < 1e-12)
+degenerate_count = int(len(keep) - np.count_nonzero(keep))
+
+# --- Rebuild the boundaries, dropping the rejected triangles ---
+keep = iter(keep.tolist())
+for geom in geometries:
+    # Keep any non-triangular faces (though there shouldn't be any)
+    geom['boundaries'] = [face for face in geom['boundaries'] if not is_triangle(face) or next(keep)]
 
 # --- Save the repaired file ---
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(cm, f)
+with open(OUTPUT_FILE, 'wb') as f:
+    f.write(to_json(cm))
 
 print(f"\nProcessing complete.")
 print(f"Total faces scanned: {total_faces}")
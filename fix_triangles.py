@@ -1,34 +1,27 @@
-import json
+import numpy as np
+
+from cityjson_utils import load_json, merge_vertices, to_json
 
 INPUT_FILE = 'B4.json'
 OUTPUT_FILE = 'B4_fixed_v2.json'
 VERTEX_PRECISION = 6
+# Triangles whose squared cross product is below this are degenerate
+AREA_TOLERANCE = 1e-16
 
 print(f"Loading '{INPUT_FILE}'...")
 
-with open(INPUT_FILE, 'r') as f:
-    data = json.load(f)
+data = load_json(INPUT_FILE)
 
 # ==============================
 # STEP 1: Merge Duplicate Vertices
 # ==============================
 print("\nStep 1: Merging duplicate vertices...")
 
-old_vertices = data['vertices']
-new_vertices = []
-vertex_map = {}
-index_remap = {}
+old_vertices = np.asarray(data['vertices']).reshape(-1, 3)
 
-for old_idx, vertex in enumerate(old_vertices):
-    rounded = tuple(round(coord, VERTEX_PRECISION) for coord in vertex)
-    
-    if rounded in vertex_map:
-        index_remap[old_idx] = vertex_map[rounded]
-    else:
-        new_idx = len(new_vertices)
-        vertex_map[rounded] = new_idx
-        index_remap[old_idx] = new_idx
-        new_vertices.append(vertex)
+index_remap, kept = merge_vertices(old_vertices, VERTEX_PRECISION)
+index_remap = index_remap.tolist()
+new_vertices = old_vertices[kept]
 
 print(f"  Original vertices: {len(old_vertices)}")
 print(f"  Unique vertices: {len(new_vertices)}")
@@ -41,45 +34,32 @@ data['vertices'] = new_vertices
 # ==============================
 print("\nStep 2: Remapping indices and removing degenerate triangles...")
 
-def is_degenerate_triangle(idx0, idx1, idx2, vertices):
-    """Check if three vertex indices form a degenerate triangle"""
-    if idx0 == idx1 or idx1 == idx2 or idx0 == idx2:
-        return True
-    
-    if idx0 >= len(vertices) or idx1 >= len(vertices) or idx2 >= len(vertices):
-        return True
-    
-    p0 = vertices[idx0]
-    p1 = vertices[idx1]
-    p2 = vertices[idx2]
+def degenerate_mask(triangles, vertices, tol):
+    """Check a (T, 3) array of vertex indices for degenerate triangles in one pass"""
+    i0, i1, i2 = triangles.T
+    degenerate = (i0 == i1) | (i1 == i2) | (i0 == i2) | (triangles >= len(vertices)).any(axis=1)
     
-    v1 = [p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]]
-    v2 = [p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]]
+    # Point the rejected rows at vertex 0 so the lookups stay in range
+    safe = np.where(degenerate[:, None], 0, triangles)
+    p0 = vertices[safe[:, 0]]
+    cross = np.cross(vertices[safe[:, 1]] - p0, vertices[safe[:, 2]] - p0)
     
-    cross = [
-        v1[1] * v2[2] - v1[2] * v2[1],
-        v1[2] * v2[0] - v1[0] * v2[2],
-        v1[0] * v2[1] - v1[1] * v2[0]
-    ]
-    
-    area_sq = cross[0]**2 + cross[1]**2 + cross[2]**2
-    return area_sq < 1e-16
-
-total_removed = 0
-total_kept = 0
+    return degenerate | ((cross * cross).sum(axis=1) < tol)
 
-def process_boundary(boundary, vertices, depth=0):
+def process_boundary(boundary, triangles, triangle_rings, depth=0):
     """
     Recursively process boundaries at any nesting level.
-    Returns None if the boundary should be removed.
+    Triangles aren't decided here: their three unique indices are added to
+    `triangles` and the ring itself to `triangle_rings`, to be checked later.
+    Returns (boundary, kept, removed), where boundary is None if it should
+    be removed and kept/removed count the non-triangle rings.
     """
-    global total_removed, total_kept
-    
-    if not boundary or not isinstance(boundary, list):
-        return None
+    if not boundary or type(boundary) is not list:
+        return None, 0, 0
     
     # Check if this is a leaf node (list of indices)
-    if len(boundary) > 0 and isinstance(boundary[0], (int, float)):
+    first_type = type(boundary[0])
+    if first_type is int or first_type is float:
         # This is a ring of indices - remap them
         remapped = [index_remap[int(idx)] for idx in boundary]
         
@@ -93,35 +73,66 @@ def process_boundary(boundary, vertices, depth=0):
         if len(cleaned) > 1 and cleaned[0] == cleaned[-1]:
             cleaned = cleaned[:-1]
         
-        # Get unique indices
-        unique = list(dict.fromkeys(cleaned))
+        # Get unique indices. With consecutive and closing duplicates gone, a
+        # ring of three or fewer indices can't repeat one, so only longer
+        # rings need the dict
+        unique = cleaned if len(cleaned) <= 3 else list(dict.fromkeys(cleaned))
         
         # Check if it's a triangle
         if len(unique) == 3:
-            if is_degenerate_triangle(unique[0], unique[1], unique[2], vertices):
-                total_removed += 1
-                return None
-            else:
-                total_kept += 1
-                return remapped  # Return original remapped (may include closing vertex)
+            # Decided later by degenerate_mask
+            triangles.append(unique)
+            triangle_rings.append(remapped)
+            return remapped, 0, 0  # Return original remapped (may include closing vertex)
         elif len(unique) < 3:
-            total_removed += 1
-            return None
+            return None, 0, 1
         else:
             # Polygon with > 3 vertices
-            total_kept += 1
-            return remapped
+            return remapped, 1, 0
     
     # Not a leaf - recurse deeper
     processed = []
+    kept = removed = 0
     for item in boundary:
-        result = process_boundary(item, vertices, depth + 1)
+        result, item_kept, item_removed = process_boundary(item, triangles, triangle_rings, depth + 1)
+        kept += item_kept
+        removed += item_removed
         if result is not None:
             processed.append(result)
     
     # Only return if we have valid children
+    return (processed if len(processed) > 0 else None), kept, removed
+
+def prune_boundary(boundary, removed):
+    """
+    Drop the rings whose id() is in `removed`, along with any parent that is
+    left without children. Returns None if the boundary should be removed.
+    """
+    if id(boundary) in removed:
+        return None
+    
+    first_type = type(boundary[0])
+    if first_type is int or first_type is float:
+        return boundary
+    
+    processed = []
+    for item in boundary:
+        result = prune_boundary(item, removed)
+        if result is not None:
+            processed.append(result)
+    
     return processed if len(processed) > 0 else None
 
+total_removed = 0
+total_kept = 0
+
+# Triangles are only collected while walking the boundaries and then checked
+# all at once; these hold the three unique indices, the ring they came from
+# and the geometry that ring belongs to
+triangles = []
+triangle_rings = []
+triangle_geometries = []
+
 for obj_id, city_obj in data['CityObjects'].items():
     if 'geometry' not in city_obj:
         continue
@@ -130,13 +141,42 @@ for obj_id, city_obj in data['CityObjects'].items():
         if 'boundaries' not in geom:
             continue
         
+        found = len(triangles)
         cleaned_boundaries = []
         for boundary in geom['boundaries']:
-            result = process_boundary(boundary, new_vertices)
+            result, kept, removed = process_boundary(boundary, triangles, triangle_rings)
+            total_kept += kept
+            total_removed += removed
             if result is not None:
                 cleaned_boundaries.append(result)
         
         geom['boundaries'] = cleaned_boundaries
+        triangle_geometries += [geom] * (len(triangles) - found)
+
+# Check every collected triangle in one call
+degenerate = degenerate_mask(
+    np.array(triangles, dtype=np.int64).reshape(-1, 3),
+    new_vertices.astype(np.float64, copy=False),
+    AREA_TOLERANCE,
+)
+removed_rings = set()
+affected = {}
+for ring, geom, bad in zip(triangle_rings, triangle_geometries, degenerate.tolist()):
+    if bad:
+        removed_rings.add(id(ring))
+        affected[id(geom)] = geom
+total_removed += len(removed_rings)
+total_kept += len(triangle_rings) - len(removed_rings)
+
+# Only the geometries that lost a triangle need to be walked again
+for geom in affected.values():
+    cleaned_boundaries = []
+    for boundary in geom['boundaries']:
+        result = prune_boundary(boundary, removed_rings)
+        if result is not None:
+            cleaned_boundaries.append(result)
+    
+    geom['boundaries'] = cleaned_boundaries
 
 print(f"  Valid faces kept: {total_kept}")
 print(f"  Degenerate faces removed: {total_removed}")
@@ -146,8 +186,8 @@ print(f"  Degenerate faces removed: {total_removed}")
 # ==============================
 print(f"\nSaving to '{OUTPUT_FILE}'...")
 
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(data, f, indent=2)
+with open(OUTPUT_FILE, 'wb') as f:
+    f.write(to_json(data))
 
 print("\n" + "="*50)
 print("SUCCESS!")
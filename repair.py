@@ -0,0 +1,205 @@
+import numpy as np
+
+from cityjson_utils import (
+    JSON_ERRORS, collect_rings, flatten_rings, ijson, load_json, merge_vertices, quantize,
+    read_header, stream_city_objects, to_json, write_rings, write_streamed,
+)
+
+# --- Configuration ---
+INPUT_FILE = 'B4.json'
+OUTPUT_FILE = 'B4_clean.json'
+# How many decimal places to consider when checking if vertices are identical
+PRECISION = 5
+# Distance below which vertices are merged even if they don't round alike
+TOLERANCE = 10 ** -PRECISION
+# Geometry types whose innermost lists are polygon rings
+SURFACE_TYPES = {'MultiSurface', 'CompositeSurface', 'Solid', 'MultiSolid', 'CompositeSolid'}
+# Stream the CityObjects through one at a time instead of loading the whole
+# file, so only the vertices and a single object's boundaries are in memory.
+# Slower than the default, so only worth it for files that don't fit in
+# memory (needs ijson).
+STREAM = False
+
+# Single-pass version of cleaner.py + fix.py + fix_triangles.py: the file is
+# loaded and saved once, and every step in between works on whole arrays.
+
+def clean_ring(ring):
+    """Drop consecutive repeated indices, including a closing copy of the first one."""
+    cleaned = [idx for i, idx in enumerate(ring) if i == 0 or idx != ring[i - 1]]
+    if len(cleaned) > 1 and cleaned[0] == cleaned[-1]:
+        cleaned.pop()
+    return cleaned
+
+def degenerate_triangles(triangles, grid):
+    """
+    Return a mask of the (T, 3) triangles whose area is zero on the integer
+    vertex grid. The cross product is exact in int64, so no tolerance is
+    needed. It only overflows for triangles spanning more than ~2e9 grid
+    steps: ~20 km for float vertices in metres at PRECISION = 5, or 2e9
+    units for integer vertices, which quantize() leaves unscaled.
+    """
+    p0 = grid[triangles[:, 0]]
+    d1 = grid[triangles[:, 1]] - p0
+    d2 = grid[triangles[:, 2]] - p0
+    return ~np.cross(d1, d2).any(axis=1)
+
+def prune_boundary(boundary, removed, surfaces=True):
+    """
+    Drop the rings whose id() is in `removed`, and any list left empty.
+    With `surfaces`, a surface goes together with its exterior ring.
+    Returns None if nothing is left.
+    """
+    if id(boundary) in removed:
+        return None
+    if not boundary or type(boundary[0]) is not list:
+        return boundary
+    if surfaces and boundary[0] and type(boundary[0][0]) is not list:
+        # A surface: exterior ring followed by its interior rings
+        if id(boundary[0]) in removed:
+            return None
+        return [ring for ring in boundary if id(ring) not in removed]
+
+    pruned = []
+    for item in boundary:
+        result = prune_boundary(item, removed, surfaces)
+        if result:
+            pruned.append(result)
+    return pruned or None
+
+def repair_geometries(geometries, index_mapping, grid):
+    """
+    Remap, clean and filter the boundaries of `geometries` in place.
+    Returns the number of rings that were removed.
+    """
+    all_rings = []
+    surface_rings = []
+    for geom in geometries:
+        rings = collect_rings(geom['boundaries'])
+        all_rings += rings
+        if geom.get('type') in SURFACE_TYPES:
+            surface_rings += rings
+
+    flat = flatten_rings(all_rings)
+
+    # Check for invalid indices before trying to access them
+    removed = set()
+    invalid = (flat < 0) | (flat >= len(index_mapping))
+    if invalid.any():
+        ring_of = np.repeat(np.arange(len(all_rings)), [len(ring) for ring in all_rings])
+        for r in np.unique(ring_of[invalid]).tolist():
+            print(f"Warning: Found invalid vertex index in face {all_rings[r]}. Skipping.")
+            removed.add(id(all_rings[r]))
+        flat[invalid] = 0
+
+    # Remap every index with one gather and copy the results back
+    write_rings(all_rings, index_mapping[flat])
+
+    # Rings left with fewer than 3 distinct vertices are dropped straight
+    # away; triangles are collected and checked for zero area in one batch
+    triangles = []
+    for ring in surface_rings:
+        if id(ring) in removed:
+            continue
+        ring[:] = clean_ring(ring)
+        if len(set(ring)) < 3:
+            removed.add(id(ring))
+        elif len(ring) == 3:
+            triangles.append(ring)
+
+    if triangles:
+        degenerate = degenerate_triangles(np.array(triangles, dtype=np.int64), grid)
+        removed.update(id(ring) for ring, bad in zip(triangles, degenerate.tolist()) if bad)
+
+    if removed:
+        for geom in geometries:
+            surfaces = geom.get('type') in SURFACE_TYPES
+            geom['boundaries'] = prune_boundary(geom['boundaries'], removed, surfaces) or []
+
+    return len(removed)
+
+def object_geometries(city_objects):
+    return [
+        geom
+        for city_object in city_objects if 'geometry' in city_object
+        for geom in city_object['geometry'] if 'boundaries' in geom
+    ]
+
+print(f"Loading '{INPUT_FILE}'...")
+
+if STREAM and ijson is None:
+    print("WARNING: STREAM needs the 'ijson' package, loading the whole file instead.")
+    STREAM = False
+
+try:
+    if STREAM:
+        # CityObjects are read later, one at a time, while saving
+        cm = read_header(INPUT_FILE)
+    else:
+        cm = load_json(INPUT_FILE)
+except FileNotFoundError:
+    print(f"ERROR: Input file '{INPUT_FILE}' not found. Make sure it's in the same directory.")
+    exit()
+except JSON_ERRORS:
+    print(f"ERROR: Could not read '{INPUT_FILE}'. It may not be a valid JSON file.")
+    exit()
+
+# ==============================
+# STEP 1: Merge Duplicate Vertices
+# ==============================
+print("\nStep 1: Merging duplicate vertices...")
+
+old_vertices = np.asarray(cm['vertices']).reshape(-1, 3)
+
+# The same merge as cleaner.py
+index_mapping, kept = merge_vertices(old_vertices, PRECISION, TOLERANCE)
+new_vertices = old_vertices[kept]
+cm['vertices'] = new_vertices
+
+print(f"  Original vertices: {len(old_vertices)}")
+print(f"  Unique vertices: {len(new_vertices)}")
+
+# ==============================
+# STEP 2: Remap and Remove Degenerate Faces
+# ==============================
+print("\nStep 2: Remapping indices and removing degenerate faces...")
+
+# Degeneracy is checked on the quantized coordinates, the same grid the
+# duplicates were merged on
+grid = quantize(new_vertices, PRECISION)
+total_removed = 0
+
+def repaired_city_objects():
+    # CityObjects are read, repaired and written one at a time
+    global total_removed
+    for obj_id, city_object in stream_city_objects(INPUT_FILE):
+        total_removed += repair_geometries(object_geometries([city_object]), index_mapping, grid)
+        yield obj_id, city_object
+
+if STREAM:
+    print("  (streaming: CityObjects are repaired while saving)")
+else:
+    total_removed = repair_geometries(object_geometries(cm['CityObjects'].values()), index_mapping, grid)
+    print(f"  Degenerate faces removed: {total_removed}")
+
+# --- Optional but recommended: Add the referenceSystem if missing ---
+if 'metadata' in cm and 'referenceSystem' not in cm['metadata']:
+    print("Adding missing 'referenceSystem' to metadata...")
+    cm['metadata']['referenceSystem'] = "https://www.opengis.net/def/crs/EPSG/0/4326"
+
+# ==============================
+# STEP 3: Save
+# ==============================
+print(f"\nSaving to '{OUTPUT_FILE}'...")
+
+if STREAM:
+    write_streamed(OUTPUT_FILE, cm, repaired_city_objects())
+else:
+    with open(OUTPUT_FILE, 'wb') as f:
+        f.write(to_json(cm))
+
+print("\n" + "="*50)
+print("SUCCESS!")
+print(f"  - Merged {len(old_vertices) - len(new_vertices)} duplicate vertices")
+print(f"  - Removed {total_removed} degenerate faces")
+print("="*50)
+print(f"\nTry loading '{OUTPUT_FILE}' in your viewer now.")
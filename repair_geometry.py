@@ -1,39 +1,33 @@
-import json
-import math
+import numpy as np
 from earcut import earcut
 
+from cityjson_utils import load_json, merge_vertices, to_json, update_boundaries
+
 # --- Configuration ---
 INPUT_FILE = 'B4.json'
 OUTPUT_FILE = 'B4_repaired_final.json'
 PRECISION = 5 # Decimals to consider for merging vertices
+# Vertices closer together than this are merged into one
+TOLERANCE = 10 ** -PRECISION
 
 print(f"Starting geometry repair for '{INPUT_FILE}'...")
 
 try:
-    with open(INPUT_FILE, 'r') as f:
-        cm = json.load(f)
+    cm = load_json(INPUT_FILE)
 except Exception as e:
     print(f"ERROR reading file: {e}")
     exit()
 
 # === Part 1: Clean Duplicate Vertices ===
 print("Step 1/3: Cleaning duplicate vertices...")
-old_vertices = cm['vertices']
-new_vertices = []
-unique_vertices_map = {}
-index_mapping = [-1] * len(old_vertices)
-new_idx_counter = 0
-
-for i, v in enumerate(old_vertices):
-    rounded_v = [round(coord, PRECISION) for coord in v]
-    vertex_key = "_".join(map(str, rounded_v))
-    if vertex_key in unique_vertices_map:
-        index_mapping[i] = unique_vertices_map[vertex_key]
-    else:
-        unique_vertices_map[vertex_key] = new_idx_counter
-        index_mapping[i] = new_idx_counter
-        new_vertices.append(v)
-        new_idx_counter += 1
+old_vertices = np.asarray(cm['vertices']).reshape(-1, 3)
+
+# Each vertex joins the first kept vertex less than TOLERANCE away (no
+# rounding, and merges don't chain), so pairs that straddle a rounding
+# boundary are caught but a vertex never moves further than TOLERANCE
+index_mapping, kept = merge_vertices(old_vertices, None, TOLERANCE, transitive=False)
+# Plain lists are faster to index one vertex at a time while triangulating
+new_vertices = old_vertices[kept].tolist()
 
 cm['vertices'] = new_vertices
 print(f"--> Vertices reduced from {len(old_vertices)} to {len(new_vertices)}.")
@@ -92,29 +86,29 @@ def triangulate_face(face_rings_indices):
         ])
     return new_triangles
 
-for city_object in cm['CityObjects'].values():
-    if 'geometry' in city_object:
-        for geom in city_object['geometry']:
-            if 'boundaries' in geom:
-                # Update all old indices to new indices first
-                updated_boundaries = json.loads(json.dumps(geom['boundaries'])) # Deep copy
-                for face in updated_boundaries:
-                    for ring in face:
-                        for i, old_idx in enumerate(ring):
-                            ring[i] = index_mapping[old_idx]
-
-                # Now triangulate
-                new_boundaries = []
-                for face in updated_boundaries:
-                    triangles = triangulate_face(face)
-                    new_boundaries.extend([[triangle] for triangle in triangles])
-                
-                geom['boundaries'] = new_boundaries
+geometries = [
+    geom
+    for city_object in cm['CityObjects'].values() if 'geometry' in city_object
+    for geom in city_object['geometry'] if 'boundaries' in geom
+]
+
+# Update all old indices to new indices first (in place, the old indices
+# aren't needed once they have been remapped)
+update_boundaries([geom['boundaries'] for geom in geometries], index_mapping)
+
+# Now triangulate
+for geom in geometries:
+    new_boundaries = []
+    for face in geom['boundaries']:
+        triangles = triangulate_face(face)
+        new_boundaries.extend([[triangle] for triangle in triangles])
+    
+    geom['boundaries'] = new_boundaries
 
 # === Part 3: Save the Repaired File ===
 print("Step 3/3: Saving repaired file...")
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(cm, f)
+with open(OUTPUT_FILE, 'wb') as f:
+    f.write(to_json(cm))
 
 print(f"\nSUCCESS! Repaired file saved as '{OUTPUT_FILE}'.")
 print("This file contains only valid triangles and can be used directly in your Angular viewer.")
\ No newline at end of file